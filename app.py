@@ -10,6 +10,13 @@ import json
 from dotenv import load_dotenv
 import pandas as pd
 
+from token_budget import (
+    MODEL_MAX_RETRIES,
+    complete_with_continuations,
+    plan_token_budget,
+    record_token_usage,
+)
+
 load_dotenv()
 
 # --- PAGE CONFIG ---
@@ -343,29 +350,26 @@ FINAL INSTRUCTIONS:
 """
 
 # --- MODEL CALL wrapper ---
-def call_model_with_full_prompt(json_input_str: str):
+SYSTEM_PROMPT = (
+    "You are a strict JSON-only generator for project estimations. "
+    "Return exactly one valid JSON object with top-level keys: features, resources, tech, budget. "
+    "Follow the prompt instructions exactly. PM & QA hours must NOT be present per-feature; instead include pm_total_hours and qa_total_hours under budget. PM & QA costs must be excluded from budget totals."
+)
+
+def call_model_with_full_prompt(json_input_str: str, token_plan: dict):
     """
-    Builds the full prompt by injecting user's JSON into FULL_PROMPT_TEMPLATE and calls the model.
-    Returns the raw model text.
+    Builds the full prompt by injecting user's JSON into FULL_PROMPT_TEMPLATE and calls the model
+    through complete_with_continuations using the limits from plan_token_budget.
+    Returns (raw model text, usage report dict).
     """
     prompt_with_input = FULL_PROMPT_TEMPLATE.replace("{{json_data}}", json_input_str)
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=MODEL_MAX_RETRIES)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt_with_input},
+    ]
     try:
-        completion = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a strict JSON-only generator for project estimations. "
-                        "Return exactly one valid JSON object with top-level keys: features, resources, tech, budget. "
-                        "Follow the prompt instructions exactly. PM & QA hours must NOT be present per-feature; instead include pm_total_hours and qa_total_hours under budget. PM & QA costs must be excluded from budget totals."
-                    ),
-                },
-                {"role": "user", "content": prompt_with_input},
-            ],
-        )
-        return completion.choices[0].message.content
+        return complete_with_continuations(client, messages, token_plan)
     except Exception as e:
         # propagate for the UI to handle
         raise RuntimeError(f"Model/API error: {e}")
@@ -389,9 +393,10 @@ if generate:
     }
 
     json_data = json.dumps(data, indent=2)
+    token_plan = plan_token_budget(data["product_level"], platforms, data["project_description"])
     with st.spinner("🧠 Generating estimation using GPT-5..."):
         try:
-            response = call_model_with_full_prompt(json_data)
+            response, token_report = call_model_with_full_prompt(json_data, token_plan)
         except Exception as e:
             st.error(str(e))
             st.stop()
@@ -400,6 +405,32 @@ if generate:
     st.markdown("<div class='result-section'>", unsafe_allow_html=True)
     st.success("✅ Estimation Generated Successfully!")
 
+    # ---- TOKEN USAGE (predicted vs actual) ----
+    with st.expander("🔢 Token Usage (predicted vs actual)"):
+        t1, t2, t3 = st.columns([2, 2, 2])
+        with t1:
+            st.metric("Predicted Tokens", str(token_report["predicted_tokens"]))
+        with t2:
+            actual = token_report["actual_tokens"]
+            st.metric(
+                "Actual Tokens",
+                str(actual) if actual else "N/A",
+                delta=(actual - token_report["predicted_tokens"]) if actual else None,
+                delta_color="off",
+            )
+        with t3:
+            st.metric("Token Limit", str(token_report["max_completion_tokens"]))
+        st.caption(
+            f"Prediction source: {token_report['source']} · timeout {token_report['timeout_seconds']}s · "
+            f"continuations {token_report['continuations']} · empty retries {token_report['empty_retries']} · "
+            f"finish_reason {token_report['finish_reason']} · "
+            f"tokens per attempt {token_report['attempt_tokens']} · "
+            f"wasted on empty attempts {token_report['wasted_tokens']}"
+            + (f" · stopped early: {token_report['interrupted']}" if token_report["interrupted"] else "")
+        )
+        if token_report["finish_reason"] == "length":
+            st.warning("⚠️ Output was still truncated after the allowed retries or time limit; the JSON may be incomplete.")
+
     # Extract JSON robustly
     parsed_json = None
     try:
@@ -415,6 +446,22 @@ if generate:
         st.warning(f"⚠️ Could not parse JSON automatically: {e}")
         parsed_json = None
 
+    # Only learn from complete single-attempt runs: a truncated or unparseable reply understates
+    # the real size, and continued runs depend on the previous limit rather than on the inputs
+    if (
+        parsed_json is not None
+        and token_report["finish_reason"] != "length"
+        and token_report["continuations"] == 0
+        and token_report["actual_tokens"]
+    ):
+        record_token_usage(
+            data["product_level"],
+            platforms,
+            data["project_description"],
+            token_report["predicted_tokens"],
+            token_report["actual_tokens"],
+        )
+
     st.subheader("📘 Readable Markup (if any)")
     # Show any text before JSON if present (often none because we enforce JSON-only)
     try:
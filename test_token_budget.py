@@ -0,0 +1,216 @@
+# Tests for token_budget.py — run with: python -m pytest -q
+# A stub client stands in for openai.OpenAI, so no network or API key is needed.
+
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import token_budget as tb
+
+
+def make_history(n, level=None, coef=(8000, 4000, 1000, 3)):
+    """n runs generated from known coefficients, varying level (unless fixed), platforms and length."""
+    history = []
+    for i in range(n):
+        run_level = level or ["POC", "MVP", "Full Product"][i % 3]
+        platform_count = 1 + i % 4
+        description_chars = 100 + 150 * i
+        history.append(
+            {
+                "product_level": run_level,
+                "platform_count": platform_count,
+                "description_chars": description_chars,
+                "actual_tokens": coef[0]
+                + coef[1] * tb.PRODUCT_LEVEL_INDEX[run_level]
+                + coef[2] * platform_count
+                + coef[3] * description_chars,
+            }
+        )
+    return history
+
+
+class StubClient:
+    """
+    Returns queued (content, finish_reason, completion_tokens[, reasoning_tokens]) replies,
+    or raises queued exceptions.
+    """
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        content, finish_reason, tokens, *reasoning = reply
+        return SimpleNamespace(
+            choices=[SimpleNamespace(finish_reason=finish_reason, message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                completion_tokens=tokens,
+                completion_tokens_details=SimpleNamespace(reasoning_tokens=reasoning[0] if reasoning else 0),
+            ),
+        )
+
+
+def plan(max_tokens=6000):
+    return {
+        "predicted_tokens": 4000,
+        "max_completion_tokens": max_tokens,
+        "timeout_seconds": tb.request_timeout(max_tokens),
+        "source": "prior",
+    }
+
+
+# --- budgeting ---
+def test_plan_clamps_to_minimum_budget():
+    history = make_history(20, coef=(500, 100, 50, 0.1))
+    result = tb.plan_token_budget("POC", [], "", history=history)
+    assert result["source"] == "regression (20 runs)"
+    assert result["max_completion_tokens"] == tb.MIN_TOKEN_BUDGET
+
+
+def test_plan_clamps_to_maximum_budget():
+    result = tb.plan_token_budget("Full Product", ["Web"] * 4, "x" * 100000, history=[])
+    assert result["predicted_tokens"] == tb.MAX_TOKEN_BUDGET
+    assert result["max_completion_tokens"] == tb.MAX_TOKEN_BUDGET
+    assert result["timeout_seconds"] == tb.MAX_TIMEOUT_SECONDS
+
+
+def test_fit_uses_prior_when_history_is_sparse():
+    coef, source = tb.fit_token_model(make_history(tb.MIN_HISTORY_SAMPLES - 1))
+    assert coef == tb.PRIOR_TOKEN_COEFFICIENTS
+    assert source == "prior"
+
+
+def test_fit_uses_prior_when_history_is_rank_deficient():
+    # every run has the same product level, so its column is collinear with the intercept
+    coef, source = tb.fit_token_model(make_history(20, level="MVP"))
+    assert coef == tb.PRIOR_TOKEN_COEFFICIENTS
+    assert source == "prior"
+
+
+def test_fit_recovers_coefficients_from_history():
+    history = make_history(20)
+    coef, source = tb.fit_token_model(history)
+    assert source == "regression (20 runs)"
+    predicted = sum(c * x for c, x in zip(coef, tb.token_features("MVP", ["Web", "iOS"], "x" * 600)))
+    assert abs(predicted - (8000 + 4000 + 2000 + 1800)) < 1
+
+
+# --- corrupt history ---
+def test_load_history_ignores_non_dict_entries(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_text("[1, 2, 3]")
+    assert tb.load_token_history(str(path)) == []
+    assert tb.fit_token_model([1, 2, 3]) == (tb.PRIOR_TOKEN_COEFFICIENTS, "prior")
+
+
+def test_load_history_ignores_invalid_utf8(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_bytes(b"\xff\xfe\x00garbage")
+    assert tb.load_token_history(str(path)) == []
+
+
+def test_record_usage_moves_corrupt_file_aside(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_bytes(b"\xff\xfe\x00garbage")
+    tb.record_token_usage("MVP", ["Web"], "desc", 5000, 5200, path=str(path))
+    history = tb.load_token_history(str(path))
+    assert len(history) == 1
+    assert history[0]["actual_tokens"] == 5200
+    corrupt = list(tmp_path.glob("history.json.corrupt-*"))
+    assert len(corrupt) == 1
+    assert corrupt[0].read_bytes() == b"\xff\xfe\x00garbage"
+
+
+def test_record_usage_appends_and_leaves_no_temp_files(tmp_path):
+    path = tmp_path / "history.json"
+    for actual in (5000, 6000, 7000):
+        tb.record_token_usage("MVP", ["Web"], "desc", 5000, actual, path=str(path))
+    assert [h["actual_tokens"] for h in tb.load_token_history(str(path))] == [5000, 6000, 7000]
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+# --- continuation loop ---
+def test_continues_after_length_and_stops_when_complete():
+    client = StubClient([('{"features": [', "length", 6000), ('], "budget": {}}', "stop", 300)])
+    text, report = tb.complete_with_continuations(client, [{"role": "user", "content": "go"}], plan())
+    assert text == '{"features": [], "budget": {}}'
+    assert report["continuations"] == 1
+    assert report["finish_reason"] == "stop"
+    assert report["actual_tokens"] == 6300
+    # the partial output is sent back rather than regenerated
+    assert client.calls[1]["messages"][-2] == {"role": "assistant", "content": '{"features": ['}
+    assert client.calls[1]["messages"][-1]["content"] == tb.CONTINUE_PROMPT
+
+
+def test_continuation_reasoning_is_not_counted_again():
+    client = StubClient([('{"features": [', "length", 6000, 5000), ('], "budget": {}}', "stop", 2500, 2200)])
+    text, report = tb.complete_with_continuations(client, [], plan())
+    assert report["attempt_tokens"] == [6000, 2500]
+    assert report["actual_tokens"] == 6000 + 300
+
+
+def test_stops_after_max_continuations():
+    client = StubClient([("x", "length", 100)] * (tb.MAX_CONTINUATIONS + 2))
+    text, report = tb.complete_with_continuations(client, [], plan())
+    assert len(client.calls) == tb.MAX_CONTINUATIONS + 1
+    assert report["finish_reason"] == "length"
+    assert text == "x" * (tb.MAX_CONTINUATIONS + 1)
+
+
+def test_empty_reply_retries_with_larger_limit_without_using_a_continuation():
+    client = StubClient([("", "length", 1000), ("{}", "stop", 1200)])
+    text, report = tb.complete_with_continuations(client, [], plan(6000))
+    assert text == "{}"
+    assert client.calls[1]["max_completion_tokens"] == 12000
+    assert report["max_completion_tokens"] == 12000
+    assert report["timeout_seconds"] == tb.request_timeout(12000)
+    assert report["actual_tokens"] == 1200
+    assert report["wasted_tokens"] == 1000
+    assert report["empty_retries"] == 1
+    assert report["continuations"] == 0
+
+
+def test_deadline_caps_timeout_and_skips_attempts():
+    client = StubClient([("{}", "stop", 10)])
+    tb.complete_with_continuations(client, [], plan(), deadline_seconds=tb.MIN_ATTEMPT_SECONDS + 5)
+    assert client.calls[0]["timeout"] <= tb.MIN_ATTEMPT_SECONDS + 5
+
+    client = StubClient([])
+    text, report = tb.complete_with_continuations(client, [], plan(), deadline_seconds=0)
+    assert client.calls == []
+    assert text == ""
+    assert report["finish_reason"] is None
+
+
+def test_continuation_timeout_keeps_partial_text():
+    timeout_error = openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com"))
+    client = StubClient([('{"features": [', "length", 6000), timeout_error])
+    text, report = tb.complete_with_continuations(client, [], plan())
+    assert text == '{"features": ['
+    assert report["finish_reason"] == "length"
+    assert report["interrupted"] == "APITimeoutError"
+    assert len(client.calls) == 2
+
+
+def test_first_attempt_timeout_still_raises():
+    timeout_error = openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com"))
+    client = StubClient([timeout_error])
+    with pytest.raises(openai.APITimeoutError):
+        tb.complete_with_continuations(client, [], plan())
+
+
+def test_continuation_not_started_without_enough_time():
+    # plan() allows 130s per request, so a continuation needs 65s; only ~62s remain
+    client = StubClient([('{"features": [', "length", 6000), ("]}", "stop", 100)])
+    text, report = tb.complete_with_continuations(client, [], plan(), deadline_seconds=tb.MIN_ATTEMPT_SECONDS + 2)
+    assert len(client.calls) == 1
+    assert text == '{"features": ['
+    assert report["finish_reason"] == "length"
+    assert report["interrupted"] == "deadline"
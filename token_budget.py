@@ -0,0 +1,307 @@
+# token_budget.py
+# Output-token sizing for the estimator: predicts the completion size from the inputs, derives
+# max_completion_tokens and timeouts from it, and continues replies cut off by the length limit.
+# Kept free of Streamlit so it can be imported and tested on its own.
+# Completed runs are appended to a small JSON history file; once enough samples exist,
+# a least-squares fit over (product_level, platform count, description length) replaces
+# the prior coefficients below. The budget includes GPT-5 reasoning tokens, which count
+# against max_completion_tokens.
+
+import contextlib
+import json
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+import openai
+
+try:
+    import fcntl
+except ImportError:  # Windows: history writes are still atomic, just not serialized
+    fcntl = None
+
+TOKEN_HISTORY_PATH = os.getenv("TOKEN_HISTORY_PATH", "token_history.json")
+TOKEN_HISTORY_MAX_RECORDS = 500
+MIN_HISTORY_SAMPLES = 8
+PRODUCT_LEVEL_INDEX = {"POC": 0, "MVP": 1, "Full Product": 2}
+# intercept, per product-level step, per platform, per description character
+PRIOR_TOKEN_COEFFICIENTS = [9000.0, 5000.0, 1500.0, 2.0]
+MIN_TOKEN_BUDGET = 6000
+MAX_TOKEN_BUDGET = 64000
+TOKEN_HEADROOM = 1.5  # multiplier over the prediction so normal variance does not truncate
+MAX_CONTINUATIONS = 2  # extra "continue" requests allowed after a length cut-off
+MAX_EMPTY_RETRIES = 1  # retries with a doubled limit when a reply was all reasoning, no text
+TOKENS_PER_SECOND = 60  # conservative generation throughput used to derive timeouts
+BASE_TIMEOUT_SECONDS = 30
+MAX_TIMEOUT_SECONDS = 600
+REQUEST_DEADLINE_SECONDS = 900  # wall-clock cap across all attempts for one estimate
+MIN_ATTEMPT_SECONDS = 60  # don't start another attempt with less time than this left
+CONTINUATION_TIMEOUT_FRACTION = 0.5  # a continuation also needs at least this share of its timeout
+MODEL_MAX_RETRIES = 0  # the client's own retries would multiply the per-request timeout
+REASONING_EFFORT = "medium"
+
+
+def token_features(product_level: str, platforms, description: str):
+    """Feature row used by the token regression: [1, level, platform_count, description_chars]."""
+    return [
+        1.0,
+        float(PRODUCT_LEVEL_INDEX.get(product_level, 1)),
+        float(len(platforms or [])),
+        float(len(description or "")),
+    ]
+
+
+def _read_token_history(path: str):
+    """
+    Return the dict entries of the history file ([] if it does not exist), or None if the file
+    exists but is not a JSON list. Other OSErrors propagate.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            history = json.load(fh)
+    except FileNotFoundError:
+        return []
+    except ValueError:
+        # covers both JSONDecodeError and UnicodeDecodeError
+        return None
+    if not isinstance(history, list):
+        return None
+    return [h for h in history if isinstance(h, dict)]
+
+
+@contextlib.contextmanager
+def _history_lock(path: str):
+    """Serialize read-modify-write of the history file across sessions (no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def load_token_history(path: str = None):
+    """Return the list of stored runs, or an empty list if the file is missing/corrupt."""
+    try:
+        history = _read_token_history(path or TOKEN_HISTORY_PATH)
+    except OSError:
+        return []
+    return history or []
+
+
+def record_token_usage(
+    product_level: str, platforms, description: str, predicted: int, actual: int, path: str = None
+):
+    """
+    Append one completed run to the history file (best effort, never raises).
+    A file that no longer parses is moved aside to <path>.corrupt-<timestamp> rather than overwritten.
+    """
+    path = path or TOKEN_HISTORY_PATH
+    tmp_path = None
+    try:
+        with _history_lock(path):
+            history = _read_token_history(path)
+            if history is None:
+                os.replace(path, f"{path}.corrupt-{int(time.time())}")
+                history = []
+            history.append(
+                {
+                    "product_level": product_level,
+                    "platform_count": len(platforms or []),
+                    "description_chars": len(description or ""),
+                    "predicted_tokens": int(predicted),
+                    "actual_tokens": int(actual),
+                }
+            )
+            history = history[-TOKEN_HISTORY_MAX_RECORDS:]
+            # unique temp file in the same directory so os.replace stays atomic
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or "."
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(history, fh)
+            os.replace(tmp_path, path)
+            tmp_path = None
+    except OSError:
+        pass
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def fit_token_model(history):
+    """
+    Fit output-token coefficients on stored history with ordinary least squares.
+    Falls back to PRIOR_TOKEN_COEFFICIENTS when there are too few usable samples.
+    Returns (coefficients, source_label).
+    """
+    rows, targets = [], []
+    for h in history:
+        if not isinstance(h, dict):
+            continue
+        try:
+            rows.append(
+                [
+                    1.0,
+                    float(PRODUCT_LEVEL_INDEX.get(h.get("product_level"), 1)),
+                    float(h["platform_count"]),
+                    float(h["description_chars"]),
+                ]
+            )
+            targets.append(float(h["actual_tokens"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    if len(rows) < MIN_HISTORY_SAMPLES:
+        return PRIOR_TOKEN_COEFFICIENTS, "prior"
+
+    coef, _, rank, _ = np.linalg.lstsq(np.array(rows), np.array(targets), rcond=None)
+    if rank < len(PRIOR_TOKEN_COEFFICIENTS) or not np.all(np.isfinite(coef)):
+        return PRIOR_TOKEN_COEFFICIENTS, "prior"
+    return coef.tolist(), f"regression ({len(rows)} runs)"
+
+
+def request_timeout(max_tokens: int):
+    """Per-request timeout in seconds for a completion of up to max_tokens."""
+    return round(min(BASE_TIMEOUT_SECONDS + max_tokens / TOKENS_PER_SECOND, MAX_TIMEOUT_SECONDS))
+
+
+def plan_token_budget(product_level: str, platforms, description: str, history=None):
+    """
+    Predict the completion size and derive max_completion_tokens and the request timeout.
+    history defaults to the stored token history file.
+    Returns a dict consumed by complete_with_continuations and shown in the UI.
+    """
+    if history is None:
+        history = load_token_history()
+    coef, source = fit_token_model(history)
+    features = token_features(product_level, platforms, description)
+    predicted = sum(c * x for c, x in zip(coef, features))
+    predicted = int(min(max(predicted, MIN_TOKEN_BUDGET / TOKEN_HEADROOM), MAX_TOKEN_BUDGET))
+    max_tokens = int(min(max(math.ceil(predicted * TOKEN_HEADROOM), MIN_TOKEN_BUDGET), MAX_TOKEN_BUDGET))
+    return {
+        "predicted_tokens": predicted,
+        "max_completion_tokens": max_tokens,
+        "timeout_seconds": request_timeout(max_tokens),
+        "source": source,
+    }
+
+
+CONTINUE_PROMPT = (
+    "Your previous response was cut off by the length limit. Continue the JSON exactly where it stopped. "
+    "Do not repeat any earlier text and do not add commentary — output only the remaining characters."
+)
+
+
+def _completion_token_counts(completion):
+    """Return (completion_tokens, reasoning_tokens) from a response, treating missing usage as 0."""
+    usage = completion.usage
+    if usage is None:
+        return 0, 0
+    details = getattr(usage, "completion_tokens_details", None)
+    reasoning = getattr(details, "reasoning_tokens", None) or 0
+    return usage.completion_tokens or 0, reasoning
+
+
+def complete_with_continuations(
+    client, messages, token_plan: dict, model: str = "gpt-5", deadline_seconds: float = REQUEST_DEADLINE_SECONDS
+):
+    """
+    Call client.chat.completions.create with the limits from plan_token_budget. If the reply stops
+    with finish_reason == "length", the partial text is sent back and the model is asked to continue
+    it (up to MAX_CONTINUATIONS). A reply with no text at all is retried with a doubled limit
+    (up to MAX_EMPTY_RETRIES). All attempts share one deadline_seconds budget.
+    If a later attempt times out or loses its connection once text exists, the partial text is
+    returned with finish_reason "length" rather than discarded.
+    Each continuation reasons over the whole prompt again, so actual_tokens counts the first
+    attempt in full but only the visible output of later ones; attempt_tokens lists every attempt.
+    Returns (raw model text, usage report dict).
+    """
+    deadline = time.monotonic() + deadline_seconds
+    max_tokens = token_plan["max_completion_tokens"]
+    timeout = token_plan["timeout_seconds"]
+    text = ""
+    actual_tokens = 0
+    attempt_tokens = []  # completion tokens of each attempt that produced text
+    wasted_tokens = 0  # completion tokens spent on attempts that produced no text
+    continuations = 0
+    empty_retries = 0
+    finish_reason = None
+    interrupted = None
+    while True:
+        remaining = deadline - time.monotonic()
+        needed = MIN_ATTEMPT_SECONDS
+        if text:
+            # a continuation re-reads the whole prompt, so a sliver of time is not enough
+            needed = max(needed, timeout * CONTINUATION_TIMEOUT_FRACTION)
+        if remaining < needed:
+            if text:
+                interrupted = "deadline"
+            break
+        try:
+            completion = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_completion_tokens=max_tokens,
+                reasoning_effort=REASONING_EFFORT,
+                timeout=min(timeout, remaining),
+            )
+        except (openai.APITimeoutError, openai.APIConnectionError) as e:
+            if not text:
+                raise
+            # keep the partial output; the caller sees it as truncated
+            finish_reason = "length"
+            interrupted = type(e).__name__
+            break
+        choice = completion.choices[0]
+        finish_reason = choice.finish_reason
+        chunk = choice.message.content or ""
+        text += chunk
+        used, reasoning = _completion_token_counts(completion)
+        if chunk:
+            actual_tokens += used if not attempt_tokens else max(used - reasoning, 0)
+            attempt_tokens.append(used)
+        else:
+            wasted_tokens += used
+
+        if finish_reason != "length":
+            break
+        if chunk:
+            if continuations >= MAX_CONTINUATIONS:
+                break
+            continuations += 1
+            # keep what was produced and ask only for the remainder
+            messages = messages + [
+                {"role": "assistant", "content": chunk},
+                {"role": "user", "content": CONTINUE_PROMPT},
+            ]
+        else:
+            if empty_retries >= MAX_EMPTY_RETRIES:
+                break
+            empty_retries += 1
+            # the whole budget went to reasoning; nothing to continue, so retry with more room
+            max_tokens = min(max_tokens * 2, MAX_TOKEN_BUDGET)
+            timeout = request_timeout(max_tokens)
+
+    report = {
+        "predicted_tokens": token_plan["predicted_tokens"],
+        "actual_tokens": actual_tokens,
+        "attempt_tokens": attempt_tokens,
+        "wasted_tokens": wasted_tokens,
+        "max_completion_tokens": max_tokens,
+        "timeout_seconds": timeout,
+        "source": token_plan["source"],
+        "continuations": continuations,
+        "empty_retries": empty_retries,
+        "finish_reason": finish_reason,
+        "interrupted": interrupted,
+    }
+    return text, report